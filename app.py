@@ -1,86 +1,346 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import hashlib
+import importlib.util
 import io
-import base64
 
-# --- Page setup ---
-st.set_page_config(page_title="Pharma DUS Visualizer", layout="wide")
+# calamine is only looked up here; without it pandas picks openpyxl/xlrd.
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
 
-st.title("📊 Drug Utilization Data Visualization Tool")
+# numba is only looked up here; it is imported on the first long line chart.
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
 
-uploaded_file = st.file_uploader("📂 Upload your Excel file", type=["xlsx", "xls"])
+CHART_TYPES = ("Bar Chart", "Histogram", "Line Chart")
+MAX_PLOT_POINTS = 5000
+TOP_CATEGORIES = 15
 
-if uploaded_file:
-    df = pd.read_excel(uploaded_file)
-    st.success("✅ File uploaded successfully!")
-    st.dataframe(df.head())
-
-    st.sidebar.header("📈 Visualization Settings")
-    
-    # --- Variable selection ---
-    numeric_cols = df.select_dtypes(include=["int64", "float64"]).columns.tolist()
-    categorical_cols = df.select_dtypes(exclude=["int64", "float64"]).columns.tolist()
-    
-    chart_type = st.sidebar.selectbox("Select Chart Type", ["Bar Chart", "Histogram", "Line Chart"])
-    
-    x_axis = st.sidebar.selectbox("Select X-axis variable", df.columns)
-    y_axis = st.sidebar.selectbox("Select Y-axis variable (optional for comparison)", [None] + df.columns.tolist())
 
-    st.markdown("---")
-    st.subheader("📊 Data Visualization")
+def read_workbook(data: bytes):
+    """Read the first sheet of an uploaded workbook into a DataFrame."""
+    # .xlsx files are zip archives; legacy .xls has to go through pandas.
+    if EXCEL_ENGINE == "calamine" or not data.startswith(b"PK"):
+        return pd.read_excel(io.BytesIO(data), engine=EXCEL_ENGINE)
+
+    # Without calamine, take the raw values from openpyxl's read-only worksheet
+    # rather than the Cell objects pd.read_excel walks, then run them through the
+    # same TextParser it uses for dtype inference and header naming.
+    import openpyxl
+    from pandas.io.parsers import TextParser
+
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        # The dimensions stored in the file are often wrong; recompute them.
+        ws.reset_dimensions()
+        rows = []
+        for values in ws.values:
+            row = ["" if value is None else value for value in values]
+            while row and row[-1] == "":
+                row.pop()
+            rows.append(row)
+    finally:
+        wb.close()
+    # Like pd.read_excel, keep blank rows inside the sheet but drop trailing ones.
+    while rows and not rows[-1]:
+        rows.pop()
+    if not rows:
+        return pd.DataFrame()
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    return TextParser(rows, header=0, skip_blank_lines=False).read()
+
+
+def split_columns(df):
+    """Numeric and non-numeric column names, from one pass over ``df.dtypes``."""
+    numeric = df.dtypes.map(lambda dtype: dtype.kind in "iufc").to_numpy(dtype=bool)
+    return df.columns[numeric].tolist(), df.columns[~numeric].tolist()
+
+
+@st.cache_data(show_spinner=False)
+def load_data(data: bytes):
+    """Read the uploaded workbook and split its columns by dtype.
+
+    Also returns a digest of the upload, which the chart caches below take as
+    their key in place of hashing the whole frame on every rerun.
+    """
+    df = read_workbook(data)
+    for col, dtype in df.dtypes.items():
+        # Categorical codes make groupby and value counts work on small ints
+        # instead of hashing a Python string per row. pandas 3 loads text as
+        # StringDtype rather than object, so test for strings, not object.
+        if pd.api.types.is_string_dtype(dtype) and not isinstance(dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+        # Narrower numeric dtypes halve the bytes moved by groupby and binning.
+        elif dtype.kind in "iu":
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+        # Floats only narrow when every value survives the round trip, so the
+        # numbers shown in the preview and charts never change.
+        elif dtype.kind == "f":
+            narrow = df[col].astype(np.float32)
+            if np.array_equal(df[col].to_numpy(), narrow.to_numpy(), equal_nan=True):
+                df[col] = narrow
+    numeric_cols, categorical_cols = split_columns(df)
+    return df, numeric_cols, categorical_cols, hashlib.sha256(data).hexdigest()
+
+
+def thin(df, n=MAX_PLOT_POINTS):
+    """Return at most ``n`` rows of ``df``, randomly sampled but kept in order."""
+    return df if len(df) <= n else df.sample(n, random_state=0).sort_index()
+
+
+def lttb_indices(y, n_out):
+    """Row positions of the ``n_out`` points Largest-Triangle-Three-Buckets keeps.
+
+    Buckets run over row positions, the order the line is drawn in.
+    """
+    n = y.shape[0]
+    out = np.empty(n_out, dtype=np.int64)
+    out[0] = 0
+    out[n_out - 1] = n - 1
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        # The third vertex of each triangle is the mean of the next bucket.
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (next_start + next_end - 1) / 2.0
+        avg_y = 0.0
+        for j in range(next_start, next_end):
+            avg_y += y[j]
+        avg_y /= next_end - next_start
+
+        best = start = int(i * every) + 1
+        best_area = -1.0
+        for j in range(start, int((i + 1) * every) + 1):
+            area = abs((a - avg_x) * (y[j] - y[a]) - (a - j) * (avg_y - y[a]))
+            if area > best_area:
+                best_area = area
+                best = j
+        out[i + 1] = best
+        a = best
+    return out
+
+
+@st.cache_resource(show_spinner=False)
+def compiled_lttb():
+    """``lttb_indices`` JIT-compiled with numba, once per server process."""
+    from numba import njit
+
+    return njit(cache=True, nogil=True)(lttb_indices)
+
+
+def downsample_line(df, y_col, n=MAX_PLOT_POINTS):
+    """At most ``n`` rows of ``df`` for a line of ``y_col``, keeping its shape."""
+    if len(df) <= n:
+        return df
+    # LTTB is a per-row loop, so it needs the compiled kernel and a gap-free
+    # numeric series; otherwise fall back to an ordered random sample.
+    if not HAS_NUMBA or df[y_col].dtype.kind not in "iuf":
+        return thin(df, n)
+    y = df[y_col].to_numpy(dtype=np.float64)
+    if np.isnan(y).any():
+        return thin(df, n)
+    return df.iloc[compiled_lttb()(y, n)]
+
+
+def value_counts(series):
+    """``series.value_counts()``, as one bincount over the value codes."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series, sort=False)
+    # Missing values are coded -1 and are not counted, as in value_counts().
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    index = pd.Index(uniques, name=series.name)
+    return pd.Series(counts, index=index, name="count").sort_values(ascending=False)
+
+
+def top_k(counts, k=TOP_CATEGORIES):
+    """Keep the ``k`` largest of sorted ``counts`` and lump the rest into "Other"."""
+    if len(counts) <= k:
+        return counts
+    top = counts.iloc[:k]
+    # Don't merge the bucket into a real value that happens to be called "Other".
+    label = "Other"
+    if label in set(top.index.astype(str)):
+        label = f"Other ({len(counts) - k:,} more)"
+    return pd.concat([top, pd.Series({label: counts.iloc[k:].sum()})])
+
+
+@st.cache_data(show_spinner=False)
+def bar_series(_df, data_key, x_axis, y_axis=None):
+    """Mean of ``y_axis`` per ``x_axis`` value, or counts of ``x_axis`` alone.
+
+    Cached on ``data_key``, the upload digest; ``_df`` itself is not hashed.
+    """
+    if y_axis:
+        return _df.groupby(x_axis, observed=True)[y_axis].mean()
+    return top_k(value_counts(_df[x_axis]))
+
+
+@st.cache_data(show_spinner=False)
+def histogram_counts(_df, data_key, columns, bins=10):
+    """Bin ``columns`` on shared edges, as ``DataFrame.plot(kind='hist')`` does.
+
+    Cached on ``data_key``, the upload digest, so reruns skip pulling the
+    columns out as arrays as well as the binning; ``_df`` is not hashed.
+    """
+    values = []
+    for col in columns:
+        vals = _df[col].to_numpy()
+        values.append(vals[~np.isnan(vals)])
+    if len(values) == 1:
+        counts, edges = np.histogram(values[0], bins=bins)
+        return edges, [counts]
+    edges = np.histogram_bin_edges(np.concatenate(values), bins=bins)
+    return edges, [np.histogram(vals, bins=edges)[0] for vals in values]
+
+
+def build_export_figure(df, data_key, chart_type, x_axis, y_axis, title):
+    """Draw the selected chart with matplotlib for the PNG download."""
+    # Imported here so page loads that never export skip matplotlib entirely.
+    # A bare Figure renders through Agg and is never registered with pyplot,
+    # so it is freed with the last reference instead of leaking per export.
+    from matplotlib.figure import Figure
 
-    # --- Visualization section ---
-    fig, ax = plt.subplots(figsize=(8, 5))
+    fig = Figure(figsize=(8, 5))
+    ax = fig.subplots()
 
     if chart_type == "Bar Chart":
-        if y_axis:
-            df.groupby(x_axis)[y_axis].mean().plot(kind='bar', ax=ax)
-            ax.set_ylabel(f"Average {y_axis}")
-        else:
-            df[x_axis].value_counts().plot(kind='bar', ax=ax)
-        ax.set_title(f"{chart_type} of {x_axis}")
-        st.pyplot(fig)
+        bar_data = bar_series(df, data_key, x_axis, y_axis)
+        ax.bar(bar_data.index.astype(str), bar_data.to_numpy())
+        ax.tick_params(axis="x", labelrotation=90)
+        ax.set_xlabel(x_axis)
+        ax.set_ylabel(f"Average {y_axis}" if y_axis else "Count")
 
     elif chart_type == "Histogram":
+        columns = [x_axis, y_axis] if y_axis else [x_axis]
+        edges, counts = histogram_counts(df, data_key, columns)
+        for col, col_counts in zip(columns, counts):
+            ax.bar(edges[:-1], col_counts, width=np.diff(edges), align="edge", alpha=0.6 if y_axis else 1.0, label=col)
+        ax.set_ylabel("Frequency")
         if y_axis:
-            df[[x_axis, y_axis]].plot(kind='hist', alpha=0.6, ax=ax)
-            ax.set_title(f"Histogram of {x_axis} vs {y_axis}")
-        else:
-            df[x_axis].plot(kind='hist', bins=10, ax=ax)
-            ax.set_title(f"Histogram of {x_axis}")
-        st.pyplot(fig)
+            ax.legend()
 
     elif chart_type == "Line Chart":
+        line_df = downsample_line(df, y_axis or x_axis)
         if y_axis:
-            df.plot(x=x_axis, y=y_axis, kind='line', ax=ax)
-            ax.set_title(f"{x_axis} vs {y_axis}")
+            line_df.plot(x=x_axis, y=y_axis, kind='line', ax=ax)
         else:
-            df[x_axis].plot(kind='line', ax=ax)
-            ax.set_title(f"Line Chart of {x_axis}")
-        st.pyplot(fig)
-
-    # --- Additional fixed chart: Age vs Diagnosis ---
-    if "Age" in df.columns and "Diagnosis" in df.columns:
-        st.markdown("---")
-        st.subheader("🧍‍♂️ Age vs Diagnosis Distribution")
-        plt.figure(figsize=(8, 5))
-        df.groupby("Diagnosis")["Age"].mean().plot(kind="bar")
-        plt.title("Average Age per Diagnosis")
-        plt.ylabel("Age")
-        st.pyplot(plt)
-
-    # --- Print and Share section ---
-    st.markdown("---")
-    st.subheader("🖨️ Print / Share Data Visualization")
+            line_df[x_axis].plot(kind='line', ax=ax)
+
+    ax.set_title(title)
+    return fig
+
+
+@st.cache_data(show_spinner=False)
+def export_png(_df, data_key, chart_type, x_axis, y_axis, title):
+    """PNG bytes of the selected chart, cached so a repeat export skips matplotlib.
+
+    Keyed on ``data_key``, the upload digest; ``_df`` itself is not hashed.
+    """
+    from PIL import Image
 
+    fig = build_export_figure(_df, data_key, chart_type, x_axis, y_axis, title)
     buffer = io.BytesIO()
-    fig.savefig(buffer, format="png")
+    fig.savefig(buffer, format="png", bbox_inches="tight")
     buffer.seek(0)
-    b64 = base64.b64encode(buffer.read()).decode()
 
-    href = f'<a href="data:file/png;base64,{b64}" download="visualization.png">📤 Download Visualization</a>'
-    st.markdown(href, unsafe_allow_html=True)
+    # Charts use few distinct colours, so an 8-bit palette shrinks the PNG
+    # several-fold with no visible loss.
+    image = Image.open(buffer).quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    out = io.BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+@st.fragment
+def export_section(df, data_key, chart_type, x_axis, y_axis, title):
+    """PNG export; its buttons rerun only this fragment, not the whole page."""
+    st.markdown("---")
+    st.subheader("🖨️ Print / Share Data Visualization")
+
+    # Rasterize only on request instead of on every rerun.
+    if st.button("🖼️ Prepare PNG"):
+        st.download_button(
+            "📤 Download Visualization",
+            data=export_png(df, data_key, chart_type, x_axis, y_axis, title),
+            file_name="visualization.png",
+            mime="image/png",
+        )
+
+
+# --- Page setup ---
+st.set_page_config(page_title="Pharma DUS Visualizer", layout="wide")
+
+st.title("📊 Drug Utilization Data Visualization Tool")
+
+uploaded_file = st.file_uploader("📂 Upload your Excel file", type=["xlsx", "xls"])
 
-else:
+if not uploaded_file:
     st.info("👆 Please upload an Excel file to begin visualization.")
+    st.stop()
+
+# Keep this upload's parsed frame in session_state so reruns skip hashing the
+# file for the cache lookup and unpickling a fresh copy of the DataFrame.
+if st.session_state.get("file_id") != uploaded_file.file_id:
+    st.session_state.data = load_data(uploaded_file.getvalue())
+    st.session_state.file_id = uploaded_file.file_id
+df, numeric_cols, categorical_cols, data_key = st.session_state.data
+st.success("✅ File uploaded successfully!")
+st.dataframe(df.head())
+
+st.sidebar.header("📈 Visualization Settings")
+
+# --- Variable selection ---
+# Stable keys and hashable option tuples keep widget identity across reruns.
+chart_type = st.sidebar.selectbox("Select Chart Type", CHART_TYPES, key="chart_type")
+
+x_axis = st.sidebar.selectbox("Select X-axis variable", tuple(df.columns), key="x_axis")
+y_axis = st.sidebar.selectbox("Select Y-axis variable (optional for comparison)", (None, *numeric_cols), key="y_axis")
+
+st.markdown("---")
+st.subheader("📊 Data Visualization")
+
+# --- Visualization section ---
+# Charts are rendered client-side (WebGL where available); matplotlib is
+# only used to build the PNG download below.
+if chart_type == "Bar Chart":
+    bar_data = bar_series(df, data_key, x_axis, y_axis)
+    y_label = f"Average {y_axis}" if y_axis else "Count"
+    title = f"{chart_type} of {x_axis}"
+    # String labels keep Plotly on a category axis, in the order given here.
+    plot = px.bar(x=bar_data.index.astype(str), y=bar_data.values, labels={"x": x_axis, "y": y_label}, title=title)
+
+elif chart_type == "Histogram":
+    columns = [x_axis, y_axis] if y_axis else [x_axis]
+    title = f"Histogram of {x_axis} vs {y_axis}" if y_axis else f"Histogram of {x_axis}"
+    # Only the bin counts are sent to the browser, not the raw column.
+    edges, counts = histogram_counts(df, data_key, columns)
+    plot = go.Figure(layout={"title": title, "barmode": "overlay"})
+    for col, col_counts in zip(columns, counts):
+        plot.add_bar(x=edges[:-1], y=col_counts, width=np.diff(edges), offset=0, name=col, opacity=0.6 if y_axis else 1.0)
+
+elif chart_type == "Line Chart":
+    line_df = downsample_line(df, y_axis or x_axis)
+    title = f"{x_axis} vs {y_axis}" if y_axis else f"Line Chart of {x_axis}"
+    if len(line_df) < len(df):
+        title += f" (downsampled to {len(line_df):,} of {len(df):,} rows)"
+    if y_axis:
+        plot = px.line(line_df, x=x_axis, y=y_axis, render_mode="webgl", title=title)
+    else:
+        plot = px.line(line_df, y=x_axis, render_mode="webgl", title=title)
+
+st.plotly_chart(plot, use_container_width=True)
+
+# --- Additional fixed chart: Age vs Diagnosis ---
+if "Age" in df.columns and "Diagnosis" in df.columns:
+    st.markdown("---")
+    st.subheader("🧍‍♂️ Age vs Diagnosis Distribution")
+    st.bar_chart(bar_series(df, data_key, "Diagnosis", "Age"), x_label="Diagnosis", y_label="Average Age")
+
+# --- Print and Share section ---
+export_section(df, data_key, chart_type, x_axis, y_axis, title)